@@ -1,76 +1,284 @@
 #!/usr/bin/python3
 
+import argparse
+import hashlib
+import json
+import os
 import re
+import sys
+from concurrent.futures import ProcessPoolExecutor
 
-MARKDOWN_FILE_PATH = "./README.md"
-markdown_file = open(MARKDOWN_FILE_PATH, "r")
-current_lines = markdown_file.readlines()
-markdown_file.close()
-
-toc_title = ""
-toc_lines = [
-    "<!-- DON'T edit this section, instead run \"generate_toc.py\" to update -->\n\n",
-    "## Table of Contents {TITLE}\n\n",
-]
-toc_start = -1
-toc_end = -1
-
-# Parse for headings
-for index, line in enumerate(current_lines):
-    inside_toc = False
-    under_toc = False
-
-    if toc_start >= 0 and toc_end == -1:
-        inside_toc = True
-    elif toc_start >= 0 and index <= toc_end:
-        inside_toc = True
-
-    if toc_end != -1 and index > toc_end:
-        under_toc = True
-
-    if line.startswith("<!-- START ToC -->"):
-        toc_start = index
-
-        for key, toc_line in enumerate(toc_lines):
-            toc_line = toc_line.replace(" {TITLE}", "")
-            toc_lines[key] = toc_line
-    elif line.startswith("<!-- START ToC | "):
-        toc_start = index
-        toc_title_split = line.split("|")
-        toc_title = toc_title_split[-1].replace("-->", "").strip()
-
-        for key, toc_line in enumerate(toc_lines):
-            toc_line = toc_line.replace("{TITLE}", f'| `{toc_title}`')
-            toc_lines[key] = toc_line
-    elif line.startswith("<!-- END ToC -->"):
-        toc_end = index
-    elif line.startswith("##") and inside_toc == False and under_toc == True:
-        split_line = line.split(" ")
-        if len(split_line) > 0:
-            # Parse heading
-            heading = line.replace(split_line[0], "").strip()
-            heading_link = re.sub(
-                r"[^a-z0-9\-_]+", "", heading.lower().replace(' ', '-'), flags=re.IGNORECASE)
-            heading_size = len(split_line[0])
-            toc_lines.append(
-                f"{'  ' * (heading_size - 2)}- [{heading}](#{heading_link})\n")
-
-toc_lines.append("\n")
-
-# Make sure both the start and end ToC tags were found
-if toc_start >= 0 and toc_end > toc_start:
-    # Replace everything inside ToC tags with Table of Contents
-    current_lines = current_lines[:(toc_start + 1)] + \
-        toc_lines + current_lines[toc_end:]
-
-    # Write changes to file
-    markdown_file = open(MARKDOWN_FILE_PATH, "w")
-    markdown_file.writelines(current_lines)
-    markdown_file.close()
-
-    print(
-        f"Wrote the following ToC lines at line {str(toc_start + 2)} to line {str(toc_end)}:\n")
-    for line in toc_lines:
-        print(line, end="")
-else:
-    print("Missing <!-- START ToC --> and/or <!-- END ToC --> tags!")
+DEFAULT_PATHS = ["./README.md"]
+DEFAULT_CACHE_PATH = "./.toc_cache.json"
+# Bump whenever the generated output changes, so old cache entries are ignored
+CACHE_VERSION = 2
+
+TOC_START_TAG = "<!-- START ToC -->"
+TOC_START_TITLED_TAG = "<!-- START ToC | "
+TOC_END_TAG = "<!-- END ToC -->"
+TOC_NOTICE = "<!-- DON'T edit this section, instead run \"generate_toc.py\" to update -->"
+
+heading_reg = re.compile(r"^(#{1,6})[ \t]+(.*?)(?:[ \t]+#+)?[ \t]*$")
+fence_reg = re.compile(r"^ {0,3}(`{3,}|~{3,})")
+# Same characters GitHub strips when building heading anchors
+anchor_strip_reg = re.compile(r"[^\w\- ]")
+
+
+class AnchorSlugger:
+    """Builds unique heading anchors the same way GitHub does (`-1`, `-2` suffixes for repeats)."""
+
+    def __init__(self):
+        self.occurrences: dict[str, int] = {}
+
+    def slug(self, heading: str) -> str:
+        original_slug = anchor_strip_reg.sub("", heading.strip().lower()).replace(" ", "-")
+        result = original_slug
+
+        while result in self.occurrences:
+            self.occurrences[original_slug] += 1
+            result = f"{original_slug}-{self.occurrences[original_slug]}"
+
+        self.occurrences[result] = 0
+        return result
+
+
+def parse_heading(line: str):
+    """Returns `(level, text)` for an ATX heading line, otherwise `None`."""
+    match = heading_reg.match(line.rstrip("\r\n"))
+    if match is None:
+        return None
+    return len(match.group(1)), match.group(2)
+
+
+def toc_title_heading(toc_title: str) -> str:
+    if toc_title:
+        return f"Table of Contents | `{toc_title}`"
+    return "Table of Contents"
+
+
+def process_file(path: str, cached: dict | None, check: bool) -> dict:
+    """Regenerates the ToC of a single Markdown file, errors are returned instead of raised."""
+    try:
+        return update_toc(path, cached, check)
+    except (OSError, UnicodeDecodeError) as error:
+        return {"path": path, "status": "error", "error": str(error), "cache": None}
+
+
+def update_toc(path: str, cached: dict | None, check: bool) -> dict:
+    """Regenerates the ToC of a single Markdown file, reading it in one streaming pass."""
+    stat = os.stat(path)
+
+    # Untouched since the last run, nothing to do
+    if cached is not None and cached["size"] == stat.st_size and cached["mtime_ns"] == stat.st_mtime_ns:
+        return {"path": path, "status": cached["status"], "cache": cached}
+
+    digest = hashlib.sha256()
+    before_lines: list[str] = []
+    old_toc_lines: list[str] = []
+    after_lines: list[str] = []
+    toc_title = ""
+    toc_entries: list[str] = []
+    slugger = AnchorSlugger()
+    state = "before"
+    fence = None
+    newline = None
+
+    with open(path, "r", encoding="utf-8", newline="") as markdown_file:
+        for line in markdown_file:
+            digest.update(line.encode("utf-8"))
+            if newline is None:
+                newline = "\r\n" if line.endswith("\r\n") else "\n"
+
+            if state == "toc":
+                if line.startswith(TOC_END_TAG):
+                    state = "after"
+                    after_lines.append(line)
+                else:
+                    old_toc_lines.append(line)
+                continue
+
+            if state == "before":
+                before_lines.append(line)
+            else:
+                after_lines.append(line)
+
+            # Headings and tags inside code blocks are just text
+            fence_match = fence_reg.match(line)
+            if fence is not None:
+                if fence_match is not None and fence_match.group(1)[0] == fence[0] \
+                        and len(fence_match.group(1)) >= len(fence) and line.strip() == fence_match.group(1):
+                    fence = None
+                continue
+            if fence_match is not None:
+                fence = fence_match.group(1)
+                continue
+
+            if state == "before" and (line.startswith(TOC_START_TAG) or line.startswith(TOC_START_TITLED_TAG)):
+                if line.startswith(TOC_START_TITLED_TAG):
+                    toc_title = line.split("|")[-1].replace("-->", "").strip()
+                slugger.slug(toc_title_heading(toc_title))
+                state = "toc"
+                continue
+
+            heading = parse_heading(line)
+            if heading is None:
+                continue
+
+            heading_size, heading_text = heading
+            heading_link = slugger.slug(heading_text)
+            if state == "after" and heading_size >= 2:
+                toc_entries.append(f"{'  ' * (heading_size - 2)}- [{heading_text}](#{heading_link}){newline}")
+
+    content_hash = digest.hexdigest()
+    new_cache = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": content_hash, "status": "unchanged"}
+    result = {"path": path, "status": "unchanged", "cache": new_cache}
+
+    # Only the mtime changed, the content is the same as last time
+    if cached is not None and cached["sha256"] == content_hash:
+        result["status"] = new_cache["status"] = cached["status"]
+        return result
+
+    # Make sure both the start and end ToC tags were found (cached too, so these files aren't re-read every run)
+    if state != "after":
+        result["status"] = new_cache["status"] = "missing_tags"
+        return result
+
+    toc_lines = [
+        f"{TOC_NOTICE}{newline}",
+        newline,
+        f"## {toc_title_heading(toc_title)}{newline}",
+        newline,
+    ] + toc_entries + [newline]
+
+    # Headings didn't change, leave the file (and its mtime) alone
+    if toc_lines == old_toc_lines:
+        return result
+
+    result["status"] = "outdated"
+    result["toc_lines"] = toc_lines
+    result["toc_start"] = len(before_lines)
+    result["toc_end"] = len(before_lines) + len(toc_lines)
+    result["cache"] = None
+
+    if check:
+        return result
+
+    new_lines = before_lines + toc_lines + after_lines
+    with open(path, "w", encoding="utf-8", newline="") as markdown_file:
+        markdown_file.writelines(new_lines)
+
+    stat = os.stat(path)
+    result["status"] = "written"
+    result["cache"] = {
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "sha256": hashlib.sha256("".join(new_lines).encode("utf-8")).hexdigest(),
+        "status": "unchanged",
+    }
+    return result
+
+
+def find_markdown_files(paths: list[str]) -> list[str]:
+    """Expands directories into the Markdown files inside them (hidden folders are skipped)."""
+    markdown_files = []
+
+    for path in paths:
+        if not os.path.isdir(path):
+            markdown_files.append(os.path.normpath(path))
+            continue
+
+        for root, dirs, files in os.walk(path):
+            dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+            for file in sorted(files):
+                if file.lower().endswith(".md"):
+                    markdown_files.append(os.path.normpath(os.path.join(root, file)))
+
+    return list(dict.fromkeys(markdown_files))
+
+
+def load_cache(cache_path: str) -> dict:
+    try:
+        with open(cache_path, "r", encoding="utf-8") as cache_file:
+            cache = json.load(cache_file)
+    except (OSError, ValueError):
+        return {}
+
+    if not isinstance(cache, dict) or cache.get("version") != CACHE_VERSION:
+        return {}
+    return cache.get("files", {})
+
+
+def save_cache(cache_path: str, files: dict):
+    with open(cache_path, "w", encoding="utf-8") as cache_file:
+        json.dump({"version": CACHE_VERSION, "files": files}, cache_file, indent=2, sort_keys=True)
+        cache_file.write("\n")
+
+
+def positive_int(value: str) -> int:
+    number = int(value)
+    if number <= 0:
+        raise argparse.ArgumentTypeError(f"must be greater than 0, got {value}")
+    return number
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description="Generates the Table of Contents between the <!-- START ToC --> and <!-- END ToC --> tags of Markdown files.")
+    parser.add_argument("paths", nargs="*", default=DEFAULT_PATHS,
+                        help="Markdown files and/or directories to search for Markdown files (default: ./README.md)")
+    parser.add_argument("--check", action="store_true",
+                        help="don't write anything (not even the cache), exit with status 1 if any ToC is out of date (for CI)")
+    parser.add_argument("--cache", default=DEFAULT_CACHE_PATH,
+                        help=f"path of the content hash cache (default: {DEFAULT_CACHE_PATH})")
+    parser.add_argument("--no-cache", action="store_true", help="ignore and don't update the cache")
+    parser.add_argument("-j", "--jobs", type=positive_int, default=None,
+                        help="number of files to process in parallel (default: number of CPUs)")
+    args = parser.parse_args()
+
+    explicit_files = {os.path.normpath(path) for path in args.paths if not os.path.isdir(path)}
+    markdown_files = find_markdown_files(args.paths)
+    cache = {} if args.no_cache else load_cache(args.cache)
+
+    with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        results = list(executor.map(
+            process_file,
+            markdown_files,
+            [cache.get(path) for path in markdown_files],
+            [args.check] * len(markdown_files),
+        ))
+
+    failed = False
+    for result in results:
+        path = result["path"]
+
+        if result["cache"] is None:
+            cache.pop(path, None)
+        else:
+            cache[path] = result["cache"]
+
+        match result["status"]:
+            case "missing_tags":
+                # Directories may contain plenty of files without a ToC, only complain about explicit ones
+                if path in explicit_files:
+                    failed = True
+                    print(f"{path}: Missing <!-- START ToC --> and/or <!-- END ToC --> tags!")
+            case "error":
+                failed = True
+                print(f"{path}: {result['error']}")
+            case "outdated":
+                failed = True
+                print(f"{path}: ToC is out of date, run \"generate_toc.py\" to update it")
+            case "written":
+                print(
+                    f"{path}: Wrote the following ToC lines at line {str(result['toc_start'] + 1)} to line {str(result['toc_end'])}:\n")
+                for line in result["toc_lines"]:
+                    print(line, end="")
+
+    if not args.no_cache and not args.check:
+        save_cache(args.cache, cache)
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,138 @@
+import os
+import subprocess
+import sys
+
+from generate_toc import AnchorSlugger, process_file
+
+SCRIPT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "generate_toc.py")
+
+MARKDOWN = (
+    "# Title\n"
+    "<!-- START ToC -->\n"
+    "<!-- END ToC -->\n"
+    "## Exceptions\n"
+    "```\n"
+    "## Not a heading\n"
+    "```\n"
+    "### Exceptions\n"
+    "## Exceptions-1\n"
+    "## Exceptions\n"
+)
+
+EXPECTED_TOC = (
+    "- [Exceptions](#exceptions)\n"
+    "  - [Exceptions](#exceptions-1)\n"
+    "- [Exceptions-1](#exceptions-1-1)\n"
+    "- [Exceptions](#exceptions-2)\n"
+)
+
+
+def write_markdown(tmp_path, content=MARKDOWN, name="doc.md", newline="\n"):
+    path = tmp_path / name
+    path.write_bytes(content.replace("\n", newline).encode("utf-8"))
+    return str(path)
+
+
+def run_script(*args, cwd):
+    return subprocess.run([sys.executable, SCRIPT_PATH, *args], cwd=cwd, capture_output=True, text=True)
+
+
+def test_slugger_suffixes_repeats():
+    slugger = AnchorSlugger()
+
+    assert slugger.slug("Use `error_log` in error handler") == "use-error_log-in-error-handler"
+    assert slugger.slug("Exceptions") == "exceptions"
+    assert slugger.slug("Exceptions") == "exceptions-1"
+    assert slugger.slug("Exceptions-1") == "exceptions-1-1"
+    assert slugger.slug("Exceptions") == "exceptions-2"
+
+
+def test_writes_toc_and_skips_fences(tmp_path):
+    path = write_markdown(tmp_path)
+
+    result = process_file(path, None, False)
+
+    assert result["status"] == "written"
+    content = open(path, encoding="utf-8").read()
+    assert EXPECTED_TOC in content
+    assert "not-a-heading" not in content
+
+
+def test_unchanged_toc_is_not_rewritten(tmp_path):
+    path = write_markdown(tmp_path)
+    process_file(path, None, False)
+    os.utime(path, ns=(0, 0))
+
+    result = process_file(path, None, False)
+
+    assert result["status"] == "unchanged"
+    assert os.stat(path).st_mtime_ns == 0
+
+
+def test_cache_hit_and_miss(tmp_path):
+    path = write_markdown(tmp_path)
+    cache = process_file(path, None, False)["cache"]
+
+    # Same size and mtime, the file isn't even read (so the swapped content goes unnoticed)
+    content = open(path, encoding="utf-8").read()
+    with open(path, "w", encoding="utf-8") as markdown_file:
+        markdown_file.write(content.replace("## Exceptions-1", "## Exceptions-2"))
+    os.utime(path, ns=(cache["mtime_ns"], cache["mtime_ns"]))
+    assert process_file(path, cache, False) == {"path": path, "status": "unchanged", "cache": cache}
+    with open(path, "w", encoding="utf-8") as markdown_file:
+        markdown_file.write(content)
+
+    # Touched but identical content
+    os.utime(path, ns=(1, 1))
+    result = process_file(path, cache, False)
+    assert result["status"] == "unchanged"
+    assert result["cache"]["mtime_ns"] == 1
+
+    # Headings changed
+    with open(path, "a", encoding="utf-8") as markdown_file:
+        markdown_file.write("## New heading\n")
+    assert process_file(path, result["cache"], False)["status"] == "written"
+
+
+def test_missing_tags_are_cached(tmp_path):
+    path = write_markdown(tmp_path, "## No ToC here\n")
+
+    result = process_file(path, None, False)
+
+    assert result["status"] == "missing_tags"
+    assert process_file(path, result["cache"], False)["status"] == "missing_tags"
+
+
+def test_keeps_crlf_line_endings(tmp_path):
+    path = write_markdown(tmp_path, newline="\r\n")
+
+    assert process_file(path, None, False)["status"] == "written"
+    content = open(path, "rb").read()
+    assert content.count(b"\n") == content.count(b"\r\n")
+    assert process_file(path, None, False)["status"] == "unchanged"
+
+
+def test_errors_are_returned(tmp_path):
+    missing_path = str(tmp_path / "missing.md")
+    invalid_path = tmp_path / "invalid.md"
+    invalid_path.write_bytes(b"## \xff\n")
+
+    assert process_file(missing_path, None, False)["status"] == "error"
+    assert process_file(str(invalid_path), None, False)["status"] == "error"
+
+
+def test_check_mode_exit_codes(tmp_path):
+    path = write_markdown(tmp_path)
+    before = open(path, encoding="utf-8").read()
+
+    assert run_script("--check", path, cwd=tmp_path).returncode == 1
+    assert open(path, encoding="utf-8").read() == before
+    assert not (tmp_path / ".toc_cache.json").exists()
+
+    assert run_script(path, cwd=tmp_path).returncode == 0
+    assert run_script("--check", path, cwd=tmp_path).returncode == 0
+
+    no_tags_path = write_markdown(tmp_path, "## No ToC here\n", name="no_tags.md")
+    assert run_script("--check", no_tags_path, cwd=tmp_path).returncode == 1
+    assert run_script("--check", str(tmp_path / "missing.md"), cwd=tmp_path).returncode == 1
+    assert run_script("-j", "0", path, cwd=tmp_path).returncode == 2